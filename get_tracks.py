@@ -6,35 +6,58 @@ Multiple methods to extract track information from Apple Music playlist URLs.
 Since Apple Music doesn't have a public API, these methods use various workarounds.
 
 Required libraries:
-pip install requests beautifulsoup4 selenium webdriver-manager lxml yt_dlp fuzzywuzzy
+pip install requests selectolax selenium webdriver-manager lxml yt_dlp rapidfuzz orjson numpy
 """
 
 import argparse
-import json
+import hashlib
+import orjson
 import re
+import threading
 import os
 import time
 from pprint import pprint
-from typing import List, Dict, Optional
-from dataclasses import dataclass
+from typing import List, Dict, Optional, TypedDict
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from selectolax.lexbor import LexborHTMLParser
 from urllib.parse import urlparse, parse_qs
+import numpy as np
 import yt_dlp
-from fuzzywuzzy import fuzz
+from rapidfuzz import fuzz, process
 
 DEBUG=False
 
-@dataclass
-class Track:
-    """Represents a track with metadata"""
+# Apple Music playlist URLs typically look like:
+# https://music.apple.com/us/playlist/playlist-name/pl.u-abc123
+# https://music.apple.com/us/playlist/playlist-name/pl.abc123
+_PLAYLIST_PATTERNS = [re.compile(p) for p in (
+    r'/playlist/[^/]+/(pl\.[a-zA-Z0-9_-]+)',
+    r'playlist/(pl\.[a-zA-Z0-9_-]+)',
+    r'playlist/([a-zA-Z0-9._-]+)$',
+)]
+
+# Upper bound on the size of a playlist page we are willing to buffer
+MAX_PAGE_BYTES = 20 * 1024 * 1024
+
+# Contents of the <script type="application/json"> blobs embedded in playlist pages
+_JSON_SCRIPT_RE = re.compile(rb'<script[^>]*\btype="application/json"[^>]*>(.*?)</script>', re.DOTALL)
+
+# Fields of a YouTube search entry needed to score and download it
+_SEARCH_FIELDS = ('id', 'title', 'duration', 'artists')
+
+# Brackets and filler words stripped from YouTube titles before matching
+_NOISE_RE = re.compile(r'[\(\)\[\]]|\b(?:hd|4k|mv|original|lyrics|video|official|audio)\b', re.IGNORECASE)
+
+class Track(TypedDict):
+    """Represents a track with metadata, in the shape written to the tracklist"""
     title: str
     artist: str
-    album: str = ""
-    duration: int = 0
-    track_number: int = 0
-    album_art_url: str = ""
-    url: str = ""
+    album: str
+    duration: int
+    url: str
 
 class AppleMusicExtractor:
     """Extract tracks from Apple Music playlists using various methods"""
@@ -44,27 +67,37 @@ class AppleMusicExtractor:
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         })
+        # Pool connections so repeated playlist fetches reuse the TLS connection
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=10,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+        )
+        self.session.mount('https://', adapter)
     
     def extract_playlist_id(self, url: str) -> Optional[str]:
         """Extract playlist ID from Apple Music URL"""
-        # Apple Music playlist URLs typically look like:
-        # https://music.apple.com/us/playlist/playlist-name/pl.u-abc123
-        # https://music.apple.com/us/playlist/playlist-name/pl.abc123
-        
-        patterns = [
-            r'/playlist/[^/]+/(pl\.[a-zA-Z0-9_-]+)',
-            r'playlist/(pl\.[a-zA-Z0-9_-]+)',
-            r'playlist/([a-zA-Z0-9._-]+)$'
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, url)
+        for pattern in _PLAYLIST_PATTERNS:
+            match = pattern.search(url)
             if match:
                 print(match.group(1))
                 return match.group(1)
         
         return None
     
+    def fetch_page(self, url: str) -> bytes:
+        """Stream a page into memory, refusing pages larger than MAX_PAGE_BYTES"""
+        with self.session.get(url, stream=True) as response:
+            response.raise_for_status()
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                size += len(chunk)
+                if size > MAX_PAGE_BYTES:
+                    raise ValueError(f"Page exceeds {MAX_PAGE_BYTES} bytes: {url}")
+                chunks.append(chunk)
+        return b''.join(chunks)
+
     def method1_web_scraping(self, playlist_url: str) -> List[Track]:
         """
         Method 1: Basic web scraping (limited effectiveness)
@@ -74,22 +107,23 @@ class AppleMusicExtractor:
         
         try:
             if not DEBUG: 
-                response = self.session.get(playlist_url)
-                response.raise_for_status()
-                soup = BeautifulSoup(response.content, 'html.parser')
+                html_content = self.fetch_page(playlist_url)
             else: 
-                with open("./output.html", "r", encoding="utf-8") as file:
+                with open("./output.html", "rb") as file:
                     html_content = file.read()
-                soup = BeautifulSoup(html_content, 'html.parser')
 
             
             tracks = []
             
-            # Look for JSON-LD structured data
-            scripts = soup.find_all('script', type='application/json')
-            for i, script in enumerate(scripts):
+            # Look for JSON-LD structured data - the script tags are simple enough
+            # to slice out of the raw bytes without building a full DOM
+            for i, script in enumerate(_JSON_SCRIPT_RE.finditer(html_content)):
+                text = script.group(1)
+                # Cheap substring check to skip blobs without tracks before parsing them
+                if b'"trackLockup"' not in text:
+                    continue
                 try:
-                    data = json.loads(script.string)[0]
+                    data = orjson.loads(text)[0]
                     #with open(f'./playlist_{i}.json', 'w') as f:
                     #    f.write(json.dumps(data, indent=4))
                     for td in data['data']['sections']:
@@ -97,21 +131,25 @@ class AppleMusicExtractor:
                             print(td.keys())
                             for track_data in td['items']:
                                 print(track_data.keys())
-                                track = Track(
-                                    title=track_data.get('title', ''),
-                                    artist=track_data.get('artistName', ''),
-                                    duration=track_data.get('duration',0),
-                                    url=track_data["contentDescriptor"]["url"]
-                                )
-                                tracks.append(track)
-                except json.JSONDecodeError:
+                                tracks.append({
+                                    'title': track_data.get('title', ''),
+                                    'artist': track_data.get('artistName', ''),
+                                    'album': '',
+                                    'duration': track_data.get('duration', 0),
+                                    'url': track_data["contentDescriptor"]["url"],
+                                })
+                except orjson.JSONDecodeError:
                     continue
+                # The tracks live in a single blob, no need to parse the rest
+                if tracks:
+                    break
             
             # Look for meta tags
             if not tracks:
-                title_meta = soup.find('meta', property='og:title')
+                tree = LexborHTMLParser(html_content)
+                title_meta = tree.css_first('meta[property="og:title"]')
                 if title_meta:
-                    print(f"Found playlist: {title_meta.get('content')}")
+                    print(f"Found playlist: {title_meta.attributes.get('content')}")
             
             return tracks
             
@@ -127,7 +165,7 @@ class AppleMusicExtractor:
             playlist_url: Apple Music playlist URL
         
         Returns:
-            List of Track objects
+            List of Track dicts
         """
         if methods is None:
             methods = ['scraping']
@@ -152,22 +190,19 @@ class AppleMusicExtractor:
             else:
                 print(f"✗ {method.title()} method found no tracks")
         
-        # Remove duplicates
-        unique_tracks = []
-        seen = set()
-        
+        # Remove duplicates (first occurrence wins, insertion order is kept)
+        unique = {}
         for track in all_tracks:
-            key = (track.title.lower(), track.artist.lower())
-            if key not in seen:
-                seen.add(key)
-                unique_tracks.append(track)
+            unique.setdefault((track['title'].lower(), track['artist'].lower()), track)
+        unique_tracks = list(unique.values())
         
         print(f"\nTotal unique tracks found: {len(unique_tracks)}")
         return unique_tracks
 
-def get_tracklist(playlist_url, dont_save):
+def get_tracklist(playlist_url, dont_save, extractor: Optional[AppleMusicExtractor] = None):
     """Example usage"""
-    extractor = AppleMusicExtractor()
+    if extractor is None:
+        extractor = AppleMusicExtractor()
     
     # Try all available methods
     tag = playlist_url.split('?', 1)[0].split('/')[-1]
@@ -179,29 +214,21 @@ def get_tracklist(playlist_url, dont_save):
         print("=" * 60)
         
         for i, track in enumerate(tracks, 1):
-            print(f"{i:2d}. {track.artist} - {track.title}")
-            if track.album:
-                print(f"     Album: {track.album}")
+            print(f"{i:2d}. {track['artist']} - {track['title']}")
+            if track['album']:
+                print(f"     Album: {track['album']}")
         
         # Save to JSON
         tracks_data = {
             "playlist_url": playlist_url,
             "total_tracks": len(tracks),
-            "songs": [
-                {
-                    "title": track.title,
-                    "artist": track.artist,
-                    "album": track.album,
-                    "duration": track.duration
-                }
-                for track in tracks
-            ]
+            "songs": tracks
         }
 
         if not dont_save:
             fname = f"tracks_{tag}.json" 
-            with open(fname, "w") as f:
-                json.dump(tracks_data, f, indent=2)
+            with open(fname, "wb") as f:
+                f.write(orjson.dumps(tracks_data, option=orjson.OPT_INDENT_2))
             
             print(f"\nTracks saved to: {fname}")
         return tracks_data
@@ -216,14 +243,20 @@ def get_tracklist(playlist_url, dont_save):
 
 
 class YTD:
-    def __init__(self, download_path: str = "./downloads"):
+    def __init__(self, download_path: str = "./downloads", refresh: bool = False):
         """Initialize the song downloader with specified download path."""
         self.download_path = download_path
         os.makedirs(download_path, exist_ok=True)
+        self.archive_path = f'{download_path}/downloaded.txt'
+        self.resolved_path = f'{download_path}/resolved.json'
+        # Previously resolved (title, artist) -> video mappings; on refresh they are
+        # not used for lookups but are kept so other playlists' entries survive the save
+        self.refresh = refresh
+        self.resolved = self._load_resolved()
         
         # Configure yt-dlp options for audio download
         self.ydl_opts = {
-            'download_archive': f'{download_path}/downloaded.txt',
+            'download_archive': self.archive_path,
             'format': 'bestaudio/best',
             'outtmpl': f'{download_path}/%(title)s.%(ext)s',
             'postprocessors': [{
@@ -231,10 +264,64 @@ class YTD:
                 'preferredcodec': 'mp3',
                 'preferredquality': '192',
             }],
+            'concurrent_fragment_downloads': 4,
+            'postprocessor_args': {'ffmpeg': ['-threads', '2']},
             'quiet': False,
             'no_warnings': False,
         }
+
+        # Keep the YoutubeDL instances resident so extractor setup and HTTP
+        # connections are reused across searches and downloads. YoutubeDL keeps
+        # unlocked per-playlist state, so each search thread gets its own instance
+        self.search_opts = {
+            'quiet': True,
+            'no_warnings': True,
+            'extract_flat': 'in_playlist',
+        }
+        self._search_local = threading.local()
+        self._download_ydl = yt_dlp.YoutubeDL(self.ydl_opts)
+
+    @property
+    def _search_ydl(self) -> yt_dlp.YoutubeDL:
+        """YoutubeDL used for searches, one per thread"""
+        ydl = getattr(self._search_local, 'ydl', None)
+        if ydl is None:
+            ydl = self._search_local.ydl = yt_dlp.YoutubeDL(self.search_opts)
+        return ydl
     
+    def _load_resolved(self) -> dict:
+        """Load the resolved track cache from a previous run"""
+        try:
+            with open(self.resolved_path, "rb") as f:
+                return orjson.loads(f.read())
+        except (FileNotFoundError, orjson.JSONDecodeError):
+            return {}
+
+    def save_resolved(self) -> None:
+        """Persist the resolved track cache, merging this run's results over the saved ones"""
+        resolved = {**self._load_resolved(), **self.resolved}
+        with open(self.resolved_path, "wb") as f:
+            f.write(orjson.dumps(resolved, option=orjson.OPT_INDENT_2))
+
+    def get_resolved(self, track: dict) -> Optional[dict]:
+        """Cached match for a track, or None if unknown or refreshing"""
+        if self.refresh:
+            return None
+        return self.resolved.get(self.track_key(track))
+
+    @staticmethod
+    def track_key(track: dict) -> str:
+        """Cache key for a track, stable across runs"""
+        return hashlib.sha1(f"{track['artist']}|{track['title']}".encode()).hexdigest()
+
+    def downloaded_ids(self) -> set:
+        """IDs of the YouTube videos already recorded in the download archive"""
+        try:
+            with open(self.archive_path, "r") as f:
+                return {line.split()[-1] for line in f if line.strip()}
+        except FileNotFoundError:
+            return set()
+
     def search_song(self, search_query: str, max_results: int = 5) -> list:
         """
         Search for a song on YouTube and return search results.
@@ -247,103 +334,170 @@ class YTD:
         Returns:
             List of dictionaries containing video information
         """ 
-        search_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': True,
-        }
-        
-        with yt_dlp.YoutubeDL(search_opts) as ydl:
-            try:
-                # Search YouTube
-                search_results = ydl.extract_info(
-                    f"ytsearch{max_results}:{search_query}",
-                    download=False
-                )
-                
-                if 'entries' in search_results:
-                    return search_results['entries']
-                else:
-                    return []
-                    
-            except Exception as e:
-                print(f"Error searching for song: {e}")
+        try:
+            # Search YouTube
+            search_results = self._search_ydl.extract_info(
+                f"ytsearch{max_results}:{search_query}",
+                download=False
+            )
+            
+            if 'entries' in search_results:
+                # Keep only the fields used for scoring and downloading
+                return [{key: entry.get(key) for key in _SEARCH_FIELDS} for entry in search_results['entries']]
+            else:
                 return []
+                
+        except Exception as e:
+            print(f"Error searching for song: {e}")
+            return []
+
+    def download_songs(self, video_urls: list) -> None:
+        """Download the given YouTube URLs as audio into the download path"""
+        self._download_ydl.download(video_urls)
+
+    def close(self) -> None:
+        """Close the downloader, saving cookies and closing its request handlers"""
+        self._download_ydl.close()
+
+    def artist_scores(self, orig_artist_norm: str, results: list) -> List[float]:
+        """
+        Score the original artist against the artists of every result in one batch.
+
+        Returns:
+            Best artist similarity (0-100) for each result, 0 for results without artists
+        """
+        result_artists = [[artist['name'].lower() for artist in r.get('artists') or []] for r in results]
+        flat_artists = [artist for artists in result_artists for artist in artists]
+        if not flat_artists:
+            return [0] * len(results)
+
+        scores = process.cdist([orig_artist_norm], flat_artists, scorer=fuzz.ratio,
+                               processor=None, dtype=np.uint8)[0]
+        bounds = np.cumsum([0] + [len(artists) for artists in result_artists])
+        return [float(scores[start:end].max()) if end > start else 0
+                for start, end in zip(bounds[:-1], bounds[1:])]
 
     # Match name, artist, duration
-    def calculate_confidence(self, original, result: dict) -> float:
-        """Calculate confidence score for a match"""
-        result_title = result.get('title', '').lower()
+    def calculate_confidence(self, orig_title_norm: str, orig_dur: float, result: dict, artist_score: float,
+                             min_conf: float = 0.0) -> float:
+        """Calculate confidence score for a match
+
+        The original title is expected to be lowercased already, so it can be
+        normalized once per track instead of once per result. artist_score is the
+        result's best artist similarity (0-100), batched per track by artist_scores.
+        Results that cannot beat min_conf are scored with a score_cutoff, which
+        lets RapidFuzz bail out early (e.g. on titles of very different length).
+        """
         # Remove keywords - 
-        keywords = ['(', ')', '[', ']', 'hd', 'original', 'lyrics', 'video', 'lyrics', 'official']
-        for w in keywords:
-            result_title = result_title.replace(w, '')
-        result_title = result_title.strip()
+        result_title = _NOISE_RE.sub('', result.get('title') or '').lower().strip()
         print(result_title)
-        result_artists = [artist['name'].lower() for artist in result.get('artists', [])]
-        result_artist = ', '.join(result_artists)
-        
-        original_title = original['title'].lower()
-        original_artist = original['artist'].lower()
-        
-        # Title similarity
-        title_score = fuzz.ratio(original_title, result_title) / 100
         
+        # Duration gap seconds?
+        dur_diff = abs(orig_dur - result['duration'])
+        dur_penalty = dur_diff * 0.0002
+
         # Artist similarity (check against all artists)
-        artist_scores = [fuzz.ratio(original_artist, artist) for artist in result_artists]
-        artist_score = max(artist_scores) / 100 if artist_scores else 0
+        artist_score = artist_score / 100
 
-        # Duration gap seconds?
-        dur_diff = abs(original['duration'] - result['duration'])
+        # Title similarity - lowest title score that could still beat min_conf
+        title_cutoff = max(0.0, (min_conf - artist_score * 0.6 + dur_penalty) / 0.4 * 100)
+        title_score = fuzz.ratio(orig_title_norm, result_title, processor=None, score_cutoff=title_cutoff) / 100
 
         # Overall confidence (weighted average)
-        confidence = (title_score * 0.4 + artist_score * 0.6 - dur_diff * 0.0002)
+        confidence = (title_score * 0.4 + artist_score * 0.6 - dur_penalty)
         return confidence
 
-def get_tracks_on_yt(tracks, output_dir='./downloads', thresh = 0.2):
-    ytd = YTD(output_dir)
-    # Loop over tracks, search, 
-    for track in tracks:
+def get_tracks_on_yt(tracks, output_dir='./downloads', thresh = 0.2, max_dur_diff = 60, max_workers = 10,
+                     refresh = False):
+    ytd = YTD(output_dir, refresh)
+    downloaded = ytd.downloaded_ids()
+
+    def process_track(track):
+        """Search for a single track and return its best match (or None) with the confidence"""
         track['duration'] = track['duration']/1000.0
         print(track)
+        cached = ytd.get_resolved(track)
+        if cached is not None:
+            if cached['video_id'] in downloaded:
+                print(f"Already downloaded: {track['title']}")
+                return None, None
+            return {'id': cached['video_id'], 'title': cached.get('title', track['title'])}, cached['confidence']
         # title - artist
         search_query = f"{track['title']} {track['artist']}"
-        res = ytd.search_song(search_query)
         ## artist - title
         #search_query = f"{track['artist'} {track['title'}"
-        #res = ytd.search_song(search_query)
         best_conf = thresh
         best_match = None
-        for r in res:
-            # Fuzzy match title, approx duration
-            confidence = ytd.calculate_confidence(track, r)
-            print(r['title'], r['duration'], confidence)
-            if best_conf < confidence:
-                best_match = r
-                best_conf = confidence
-
-        # download track
-        if best_match is not None:
-            print(f"Best match: {best_match['title']}")
-            print(f"URL: https://youtube.com/watch?v={best_match['id']}")
-            # Download the song
-            video_url = f"https://youtube.com/watch?v={best_match['id']}"
-            with yt_dlp.YoutubeDL(ytd.ydl_opts) as ydl:
-                ydl.download([video_url])
+        orig_title_norm = track['title'].lower()
+        orig_artist_norm = track['artist'].lower()
+        scored = set()
+        # Start with a small search and only widen it when nothing matched
+        for max_results in (5, 10):
+            if best_match is not None:
+                break
+            res = ytd.search_song(search_query, max_results)
+            # Skip results already scored, without a duration (live/upcoming) or with a wildly
+            # different duration before any fuzzy matching
+            res = [r for r in res
+                   if r['id'] not in scored and r['duration'] is not None
+                   and abs(track['duration'] - r['duration']) <= max_dur_diff]
+            scored.update(r['id'] for r in res)
+            artist_scores = ytd.artist_scores(orig_artist_norm, res)
+            # Highest confidence any result in this batch can reach (flat search entries
+            # usually carry no artists, capping confidence at the title weight)
+            max_conf = 0.4 + 0.6 * max(artist_scores, default=0) / 100
+            for r, artist_score in zip(res, artist_scores):
+                # Fuzzy match title, approx duration
+                confidence = ytd.calculate_confidence(orig_title_norm, track['duration'], r, artist_score, best_conf)
+                print(r['title'], r['duration'], confidence)
+                if best_conf < confidence:
+                    best_match = r
+                    best_conf = confidence
+                # Near-perfect match, the remaining results can't do meaningfully better
+                if best_conf > 0.9 * max_conf:
+                    break
+        return best_match, best_conf
+
+    # Searches are network bound, so run them concurrently; downloads stay on the main thread
+    download_queue = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for track, (best_match, best_conf) in zip(tracks, executor.map(process_track, tracks)):
+                # download track
+                if best_match is None:
+                    continue
+                ytd.resolved[ytd.track_key(track)] = {
+                    'video_id': best_match['id'],
+                    'title': best_match['title'],
+                    'confidence': best_conf,
+                    'ts': int(time.time()),
+                }
+                print(f"Best match: {best_match['title']}")
+                print(f"URL: https://youtube.com/watch?v={best_match['id']}")
+                download_queue.append(f"https://youtube.com/watch?v={best_match['id']}")
+
+        # Download all songs in one batch to amortize the downloader setup
+        if download_queue:
+            ytd.download_songs(download_queue)
+    finally:
+        ytd.save_resolved()
+        ytd.close()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Playlist options")
     parser.add_argument('--dont-save-tracklist', action='store_true', default=False, help="Save the extracted track data from the playlists")
     parser.add_argument('-d', '--output-dir',  default='./downloads', help="Location to download songs")
+    parser.add_argument('--refresh', action='store_true', default=False, help="Ignore previously resolved YouTube matches and search again")
     parser.add_argument('playlists', nargs='*', type=str, 
                         default=["https://music.apple.com/us/playlist/todays-hits/pl.f4d106fed2bd41149aaacabb233eb5eb"],
                         help='apple playlist urls separated by space')
     args = parser.parse_args()
+    extractor = AppleMusicExtractor()
     for url in args.playlists:
-        tracks = get_tracklist(url, args.dont_save_tracklist)
+        tracks = get_tracklist(url, args.dont_save_tracklist, extractor)
         # TODO : Read tracks from json file - modularity
         
     #with open('./tracks_pl.u-06oxp9gFYbm1vzN.json', 'r') as f:
     #    tracks = json.loads(f.read())
-    get_tracks_on_yt(tracks['songs'], args.output_dir)
+    get_tracks_on_yt(tracks['songs'], args.output_dir, refresh=args.refresh)